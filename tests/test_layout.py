@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import random
+import re
+import textwrap
+
+import pytest
+from escpos.printer import Dummy
+
+from xmlescpos import Layout
+from xmlescpos.layout import _wrap
+
+
+def render(xml):
+    """ formats xml on a dummy printer and returns the printed text without escpos commands """
+    printer = Dummy()
+    Layout(xml).format(printer)
+    return re.sub(rb'\x1b.[\x00-\xff]', b'', printer.output).decode('utf-8')
+
+
+def test_table_in_line():
+    # tables inside a line are printed through the XmlLineSerializer
+    assert render(
+        '<receipt><line>'
+        '<left><table width="20"><tr><td>a</td><td>b</td><td bold="on">c</td></tr></table></left>'
+        '<right>r</right>'
+        '</line></receipt>'
+    ) == 'a      b      c                          r\n'
+
+
+def test_streamed_root_text_and_tails():
+    # the children of a container root are printed while it is parsed,
+    # the text and tails around them must not get lost or reordered
+    assert render(
+        '<receipt>root <b>bold</b> tail <p>para</p>between<p>next</p>end</receipt>'
+    ) == 'root bold tail\npara\nbetween\nnext\nend\n'
+    assert render('<span>a <b>b</b> c</span>') == 'a b c'
+
+
+def test_non_container_root():
+    # roots which aren't containers are parsed and printed as a whole
+    assert render('<line><left>L</left><right>R</right></line>') == \
+        'L                                        R\n'
+    assert render('<table width="10"><tr><td>a</td><td>b</td></tr></table>') == 'a     b   \n'
+
+
+
+def test_buffered_output_is_flushed_before_printer_commands():
+    # text and style commands are buffered by the serializer, they must
+    # reach the printer before commands sent to it directly
+    printer = Dummy()
+    Layout(
+        '<receipt><p>before</p>'
+        '<barcode bold="on" encoding="EAN13">5449000000996</barcode>'
+        '<p>after</p><cut/></receipt>'
+    ).format(printer)
+    output = printer.output
+    barcode = output.index(b'\x1dk')
+    assert output.index(b'before\n') < barcode
+    assert b'\x1bE\x01' in output[:barcode]
+    assert output.index(b'after\n') < output.index(b'\x1dV')
+
+def test_malformed_xml_raises_before_printing():
+    # the document is streamed while printing, but must be checked up front
+    with pytest.raises(SyntaxError):
+        Layout('<receipt cut="true"><h1>TOTAL</h1><p>paid</p><p>oops</receipt>')
+
+
+def test_parse_errors_raise_before_printing():
+    # whatever the parser refuses, e.g. too deeply nested documents with
+    # lxml, must be refused up front and not halfway through printing
+    xml = '<receipt>' + '<div>' * 3000 + 'x' + '</div>' * 3000 + '</receipt>'
+    try:
+        layout = Layout(xml)
+    except SyntaxError:
+        return
+    layout.format(Dummy())
+
+
+def _textwrap(text, width):
+    try:
+        return tuple(textwrap.wrap(text, width=width))
+    except ValueError:
+        return ValueError
+
+
+def _fastwrap(text, width):
+    try:
+        return _wrap(text, width)
+    except ValueError:
+        return ValueError
+
+
+@pytest.mark.parametrize('text', [
+    '', ' ', 'a', 'one two three four', 'verylongword', 'a verylongword b',
+    'ab verylongwordthatgoeson cd', 'abcd efghij', 'abc  def', ' abc def ',
+    'tab\tseparated\nwords', 'well-known multi-part-word', '- dash -', 'a-',
+])
+@pytest.mark.parametrize('width', [-1, 0, 1, 2, 3, 4, 5, 7, 10, 40])
+def test_wrap_matches_textwrap(text, width):
+    assert _fastwrap(text, width) == _textwrap(text, width)
+
+
+def test_wrap_matches_textwrap_random():
+    rnd = random.Random(0)
+    for _ in range(2000):
+        words = [rnd.choice('ab') * rnd.randint(1, 12) for _ in range(rnd.randint(0, 6))]
+        text = rnd.choice([' ', ' ', ' ', '  ', '-', '\t']).join(words)
+        width = rnd.randint(-1, 12)
+        assert _fastwrap(text, width) == _textwrap(text, width), (text, width)
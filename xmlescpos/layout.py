@@ -4,12 +4,35 @@ from __future__ import absolute_import
 import io
 import base64
 import math
-import hashlib
 import re
-import xml.etree.ElementTree as ET
+try:
+    # lxml parses in C via libxml2, fall back to the stdlib if unavailable.
+    # Older lxml releases resolve external entities by default, don't use them.
+    from lxml import etree as ET
+    if ET.LXML_VERSION < (5,):
+        raise ImportError('lxml >= 5 is required')
+
+    # libxml2 refuses text nodes over 10MB, e.g. large data url images,
+    # unless its safety limits are lifted with huge_tree.
+    _LIBXML_MAX_TEXT_LENGTH = 10000000
+
+    def _iterparse(data):
+        # drop comments like ElementTree does, so they don't end up as table cells.
+        # Only documents big enough to hit the text limit lift the limits, and
+        # like ElementTree only internal entities are expanded.
+        return ET.iterparse(
+            io.BytesIO(data), events=('start', 'end'), remove_comments=True,
+            remove_pis=True, resolve_entities='internal',
+            huge_tree=len(data) > _LIBXML_MAX_TEXT_LENGTH)
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+    def _iterparse(data):
+        return ET.iterparse(io.BytesIO(data), events=('start', 'end'))
 from PIL import Image
 import textwrap
 import itertools
+import functools
 
 import escpos.constants as cmdset
 
@@ -18,6 +41,74 @@ import six
 
 _logger = logging.getLogger(__name__)
 
+# collapses runs of whitespace in text nodes into a single space
+_WS_RE = re.compile(r'\s+')
+
+
+def _collapse_whitespace(text):
+    """ strips text and collapses runs of whitespace to single spaces """
+    # most text nodes have nothing to collapse. isprintable() is False for
+    # all whitespace but the ascii space, so this check is exact.
+    if text.isprintable() and text[:1] != ' ' and text[-1:] != ' ' and '  ' not in text:
+        return text
+    return _WS_RE.sub(' ', text.strip())
+
+# elements printed as blocks or inline, with their text and children
+_BLOCK_TAGS = frozenset((
+    'p', 'div', 'section', 'article', 'receipt', 'header', 'footer', 'li',
+    'h1', 'h2', 'h3', 'h4', 'h5'))
+_INLINE_TAGS = frozenset(('span', 'em', 'b', 'left', 'right'))
+
+
+class _StreamedRoot:
+    """ Stands in for the root element of a document that is still being
+    parsed from the ``(event, elem)`` pairs of _iterparse(). Iterating it
+    parses up to the end of each child of the root in turn.
+
+    Printing a child's tail needs the parser to be past it, see
+    Layout._iter_container(). So a child is only cleared and removed from
+    the tree once the child after the next one has been parsed.
+    """
+
+    tail = None
+
+    def __init__(self, events, root):
+        self._events = events
+        self._root = root
+        self.tag = root.tag
+        self.attrib = root.attrib
+
+    @property
+    def text(self):
+        return self._root.text
+
+    def __iter__(self):
+        root = self._root
+        parsed = []
+        depth = 0
+        for event, elem in self._events:
+            if event == 'start':
+                depth += 1
+                continue
+            if depth == 0:
+                # end of the root element
+                break
+            depth -= 1
+            if depth:
+                continue
+
+            # elem is a complete child of the root element
+            if len(parsed) == 2:
+                done = parsed.pop(0)
+                done.clear()
+                root.remove(done)
+            parsed.append(elem)
+            yield elem
+
+        # whatever follows the root element must still be well-formed
+        for event, elem in self._events:
+            pass
+
 
 def utfstr(stuff):
     """ converts stuff to string and does without failing if stuff is a utf8 string """
@@ -27,6 +118,44 @@ def utfstr(stuff):
         return str(stuff)
 
 
+@functools.lru_cache(maxsize=1024)
+def _wrap(text, width):
+    """ Wraps text into lines of at most width characters, like textwrap.wrap().
+
+    Table cells mostly contain a few single-spaced words, which are packed
+    here directly instead of setting up a textwrap.TextWrapper for each cell.
+    Anything else (hyphens, runs of whitespace) is left to textwrap.
+    Results are cached, as the same cell texts tend to show up on every receipt.
+    """
+    words = text.split()
+    if '-' in text or ' '.join(words) != text or width <= 0:
+        return tuple(textwrap.wrap(text, width=width))
+
+    lines = []
+    line, line_len = [], 0
+    for word in words:
+        if line and line_len + 1 + len(word) <= width:
+            line.append(word)
+            line_len += 1 + len(word)
+            continue
+        if line and len(word) > width and line_len < width:
+            # like textwrap, fill up the current line with the start of a long word
+            # (or just the separating space, if nothing else fits)
+            space_left = width - line_len - 1
+            line.append(word[:space_left])
+            word = word[space_left:]
+        if line:
+            lines.append(' '.join(line))
+        # split words that don't fit on a line of their own
+        while len(word) > width:
+            lines.append(word[:width])
+            word = word[width:]
+        line, line_len = [word], len(word)
+    if line and line_len:
+        lines.append(' '.join(line))
+    return tuple(lines)
+
+
 class StyleStack:
     """As we move through the the layout document, this keeps track of
     the changing styles. We then can push the current desired styles
@@ -36,10 +165,18 @@ class StyleStack:
     column width for the current font from the printer profile.
     """
 
+    # (cmds, ordered cmds, escpos cache) shared by all instances, see __init__()
+    _cmds_cache = {}
+
     def __init__(self, profile):
         self.profile = profile
         self.cmdset = cmdset
         self.stack = []
+        # merged style values for each stack level, so lookups don't
+        # have to walk the stack
+        self._effective = []
+        # profile column widths per font, see get()
+        self._columns = {}
         self.defaults = {   # default style values
             'align': 'left',
             'underline': 'off',
@@ -71,7 +208,33 @@ class StyleStack:
             'value-width': 'int',
         }
 
-        self.cmds = {
+        # converter for each typed attribute, see enforce_type()
+        self._converters = {}
+        for attr, type_ in self.types.items():
+            if type_ == 'int':
+                self._converters[attr] = lambda v: int(float(v))
+            elif type_ == 'float':
+                self._converters[attr] = float
+            elif callable(type_):
+                self._converters[attr] = type_
+
+        # The command tables only depend on whether the printer supports
+        # more than one color. They never change after construction, so
+        # they are shared by all StyleStacks, together with the order in
+        # which the commands are issued and the resulting command strings.
+        single_color = hasattr(self.profile, 'colors') and len(self.profile.colors) < 2
+        cached = StyleStack._cmds_cache.get(single_color)
+        if cached is None:
+            cmds = self._build_cmds(single_color)
+            ordered_cmds = sorted(cmds.keys(), key=lambda x: cmds[x]['_order'])
+            cached = StyleStack._cmds_cache[single_color] = (cmds, ordered_cmds, {})
+        self.cmds, self._ordered_cmds, self._escpos_cache = cached
+
+        self.push(self.defaults)
+
+    def _build_cmds(self, single_color):
+        """ builds the translation from styles to escpos commands """
+        cmds = {
             # translation from styles to escpos commands
             # some style do not correspond to escpos command are used by
             # the serializer instead
@@ -119,76 +282,76 @@ class StyleStack:
 
         # Some printers don't understand <ESC> r (change color). Only use
         # it when the printer actually supports more than one color.
-        if hasattr(self.profile, 'colors') and len(self.profile.colors) < 2:
-            self.cmds['color']['black'] = b''
-            self.cmds['color']['red'] = b''
+        if single_color:
+            cmds['color']['black'] = b''
+            cmds['color']['red'] = b''
 
-        self.push(self.defaults)
+        return cmds
 
     def _get(self, style):
         """ what's the value of a style at the current stack level"""
-        level = len(self.stack) - 1
-        while level >= 0:
-            if style in self.stack[level]:
-                return self.stack[level][style]
-            else:
-                level = level - 1
-        return None
+        return self._effective[-1].get(style)
 
     def get(self, style):
         value = self._get(style)
 
         if style == 'width' and value == 'auto':
             font = self._get('font')
-            return self.profile.get_columns(font)
+            columns = self._columns.get(font)
+            if columns is None:
+                columns = self._columns[font] = self.profile.get_columns(font)
+            return columns
 
         return value
 
     def enforce_type(self, attr, val):
         """converts a value to the attribute's type"""
-        if attr not in self.types:
-            return utfstr(val)
-        elif self.types[attr] == 'int':
-            return int(float(val))
-        elif self.types[attr] == 'float':
-            return float(val)
-        elif callable(self.types[attr]):
-            return self.types[attr](val)
-        else:
-            return utfstr(val)
+        return self._converters.get(attr, utfstr)(val)
 
     def push(self, style=None):
         """push a new level on the stack with a style dictionnary containing style:value pairs"""
         _style = {}
-        for attr in style if style else {}:
-            if attr in self.cmds and not style[attr] in self.cmds[attr]:
-                _logger.warning('WARNING: ESC/POS PRINTING: ignoring invalid value: ' + utfstr(style[attr]) + ' for style: ' + utfstr(attr))
+        cmds = self.cmds
+        converters = self._converters
+        for attr, value in style.items() if style else ():
+            cmd_table = cmds.get(attr)
+            if cmd_table is not None and value not in cmd_table:
+                _logger.warning('WARNING: ESC/POS PRINTING: ignoring invalid value: ' + utfstr(value) + ' for style: ' + utfstr(attr))
             else:
-                _style[attr] = self.enforce_type(attr, style[attr])
+                _style[attr] = converters.get(attr, utfstr)(value)
         self.stack.append(_style)
+        self._effective.append(
+            {**self._effective[-1], **_style} if self._effective else _style.copy())
 
     def set(self, style=None):
         """overrides style values at the current stack level"""
-        _style = {}
-        for attr in style if style else {}:
-            if attr in self.cmds and not style[attr] in self.cmds[attr]:
-                _logger.warning('WARNING: ESC/POS PRINTING: ignoring invalid value: ' + utfstr(style[attr]) + ' for style: ' + utfstr(attr))
+        cmds = self.cmds
+        converters = self._converters
+        level, effective = self.stack[-1], self._effective[-1]
+        for attr, value in style.items() if style else ():
+            cmd_table = cmds.get(attr)
+            if cmd_table is not None and value not in cmd_table:
+                _logger.warning('WARNING: ESC/POS PRINTING: ignoring invalid value: ' + utfstr(value) + ' for style: ' + utfstr(attr))
             else:
-                self.stack[-1][attr] = self.enforce_type(attr, style[attr])
+                value = converters.get(attr, utfstr)(value)
+                level[attr] = value
+                effective[attr] = value
 
     def pop(self):
         """ pop a style stack level """
         if len(self.stack) > 1:
-            self.stack = self.stack[:-1]
+            self.stack.pop()
+            self._effective.pop()
 
     def to_escpos(self):
         """ converts the current style to an escpos command string """
-        cmd = b''
-        ordered_cmds = list(self.cmds.keys())
-        ordered_cmds.sort(
-            key=lambda x: self.cmds[x]['_order'])
-        for style in ordered_cmds:
-            cmd += self.cmds[style][self.get(style)]
+        key = tuple(self.get(style) for style in self._ordered_cmds)
+        cmd = self._escpos_cache.get(key)
+        if cmd is None:
+            cmd = b''.join([
+                self.cmds[style][value]
+                for style, value in zip(self._ordered_cmds, key)])
+            self._escpos_cache[key] = cmd
         return cmd
 
 
@@ -196,26 +359,32 @@ class XmlSerializer:
     """
     Converts the xml inline / block tree structure to a string,
     keeping track of newlines and spacings.
-    The string is outputted asap to the provided escpos driver.
+
+    Raw commands (styles, spacing, newlines) are collected in a buffer
+    and sent to the provided escpos driver in one write, right before
+    the next text is printed or when flush() is called. Callers that
+    talk to the printer directly must flush() first to keep the output
+    in order.
     """
 
     def __init__(self, printer):
         self.printer = printer
         self.stack = ['block']
         self.dirty = False
+        self._buf = bytearray()
 
     def start_inline(self, stylestack=None):
         """ starts an inline entity with an optional style definition """
         self.stack.append('inline')
         if self.dirty:
-            self.printer._raw(b' ')
+            self._buf.extend(b' ')
         if stylestack:
             self.style(stylestack)
 
     def start_block(self, stylestack=None):
         """ starts a block entity with an optional style definition """
         if self.dirty:
-            self.printer._raw(b'\n')
+            self._buf.extend(b'\n')
             self.dirty = False
         self.stack.append('block')
         if stylestack:
@@ -224,7 +393,7 @@ class XmlSerializer:
     def end_entity(self):
         """ ends the entity definition. (but does not cancel the active style!) """
         if self.stack[-1] == 'block' and self.dirty:
-            self.printer._raw(b'\n')
+            self._buf.extend(b'\n')
             self.dirty = False
         if len(self.stack) > 1:
             self.stack = self.stack[:-1]
@@ -232,30 +401,41 @@ class XmlSerializer:
     def pre(self, text):
         """ puts a string of text in the entity keeping the whitespace intact """
         if text:
+            self.flush()
             self.printer.text(text)
             self.dirty = True
 
     def text(self, text):
         """ puts text in the entity. Whitespace and newlines are stripped to single spaces. """
         if text:
-            text = utfstr(text)
-            text = text.strip()
-            text = re.sub('\s+', ' ', text)
+            text = _collapse_whitespace(utfstr(text))
             if text:
                 self.dirty = True
+                self.flush()
                 self.printer.text(text)
 
     def linebreak(self):
         """ inserts a linebreak in the entity """
         self.dirty = False
-        self.printer._raw(b'\n')
+        self._buf.extend(b'\n')
 
     def style(self, stylestack):
         """ apply a style to the entity (only applies to content added after the definition) """
-        self.printer._raw(stylestack.to_escpos())
+        self._buf.extend(stylestack.to_escpos())
 
     def raw(self, raw):
-        self.printer._raw(raw)
+        if isinstance(raw, six.text_type):
+            # leave the encoding of text to the printer driver
+            self.flush()
+            self.printer._raw(raw)
+        else:
+            self._buf.extend(raw)
+
+    def flush(self):
+        """ sends the buffered commands to the printer """
+        if self._buf:
+            self.printer._raw(bytes(self._buf))
+            self._buf.clear()
 
 
 class XmlLineSerializer:
@@ -273,24 +453,30 @@ class XmlLineSerializer:
         self.rwidth = max(0, self.width - self.lwidth)
         self.clwidth = 0
         self.crwidth = 0
-        self.lbuffer = ''
-        self.rbuffer = ''
+        # text fragments of the left and right part, joined in get_line()
+        self.lbuffer = []
+        self.rbuffer = []
         self.left = True
 
+    @property
+    def dirty(self):
+        """ whether the current (left or right) part has content """
+        return bool(self.clwidth if self.left else self.crwidth)
+
     def _txt(self, txt):
         if self.left:
             if self.clwidth < self.lwidth:
                 txt = txt[:max(0, self.lwidth - self.clwidth)]
-                self.lbuffer += txt
+                self.lbuffer.append(txt)
                 self.clwidth += len(txt)
         else:
             if self.crwidth < self.rwidth:
                 txt = txt[:max(0, self.rwidth - self.crwidth)]
-                self.rbuffer += txt
+                self.rbuffer.append(txt)
                 self.crwidth += len(txt)
 
     def start_inline(self, stylestack=None):
-        if (self.left and self.clwidth) or (not self.left and self.crwidth):
+        if self.dirty:
             self._txt(' ')
 
     def start_block(self, stylestack=None):
@@ -305,9 +491,7 @@ class XmlLineSerializer:
 
     def text(self, text):
         if text:
-            text = utfstr(text)
-            text = text.strip()
-            text = re.sub('\s+', ' ', text)
+            text = _collapse_whitespace(utfstr(text))
             if text:
                 self._txt(text)
 
@@ -320,18 +504,32 @@ class XmlLineSerializer:
     def raw(self, raw):
         pass
 
+    def flush(self):
+        pass
+
     def start_right(self):
         self.left = False
 
     def get_line(self):
-        return ' ' * self.indent * self.tabwidth + self.lbuffer + ' ' * \
-            (self.width - self.clwidth - self.crwidth) + self.rbuffer
+        return ''.join((
+            ' ' * self.indent * self.tabwidth,
+            ''.join(self.lbuffer),
+            ' ' * (self.width - self.clwidth - self.crwidth),
+            ''.join(self.rbuffer)))
 
 class XmlTableLayout(object):
     """ Helper class. Parses an XML table layout.
 
     Convert to ESC/POS. Send to a pyton-escpos printer object.
     """
+
+    # styles shared by all cells without attributes, see _print_table_row()
+    _TH_STYLE = {'bold': 'on', 'align': 'left'}
+    _TD_STYLE = {'bold': 'off', 'align': 'left'}
+
+    # how cell text is padded for the cell's align attribute, default is left
+    _JUSTIFY = {'right': str.rjust, 'center': str.center}
+
     def __init__(self, stylestack, serializer, min_col_size=5, col_spacing=2):
         """ Parameters:
         
@@ -344,28 +542,27 @@ class XmlTableLayout(object):
         self.serializer = serializer
         self.min_col_size = min_col_size
         self.col_spacing = col_spacing
+        # column paddings per font size factor, see _get_paddings()
+        self._paddings = {}
 
     def _normalize_colsizes(self, col_sizes):
         """ Normalizes a list of column sizes to match the maximum available 
         amount of characters on the receipt.
         """
         # find largest col size index
-        max_col_idx = max(range(len(col_sizes)), key=lambda i: col_sizes[i])
+        max_col_idx = col_sizes.index(max(col_sizes))
         # retreive default width for receipt
         width = self.stylestack.get('width')
 
         # build sum for col size normaliziation
         sum_col_size = sum(col_sizes)
-        for idx, col in enumerate(col_sizes):
-            # normalize col size (into real number)
-            size = col / sum_col_size * width
-            # each col must be at least n chars wide
-            if size < self.min_col_size:
-                size = self.min_col_size
-
-            # round to next integer, as width is measured
-            # in characters
-            col_sizes[idx] = round(size)
+        min_col_size = self.min_col_size
+        # normalize col sizes (into real numbers), each col must be
+        # at least n chars wide. round to next integer, as width is
+        # measured in characters
+        col_sizes = [
+            round(max(col / sum_col_size * width, min_col_size))
+            for col in col_sizes]
 
         # ensure that sum of all columns does not exceed maximum receipt width
         # all overflow is deducted from largest column
@@ -382,6 +579,33 @@ class XmlTableLayout(object):
         factor = 2 if is_double else 1
         return int(width / factor)
 
+    def _get_paddings(self, col_sizes):
+        """ Returns the spacing put in front of each column (but the first)
+        and the padded width of every column for the currently active font size.
+        The values only depend on the font size, so they are computed once per table.
+        """
+        is_double = self.stylestack.get('size') in ('double', 'double-width')
+        paddings = self._paddings.get(is_double)
+        if paddings is None:
+            last_idx = len(col_sizes) - 1
+            paddings = self._paddings[is_double] = (
+                # -1 takes care for the additional space character
+                # that is introduced by serializer.start_inline()
+                self._get_width(self.col_spacing - 1),
+                # again, this -1 takes care for the additional space character
+                # that is introduced by serializer.start_inline()
+                # but for the last column, no serializer.start_inline() will follow
+                # that's why in this case we need to actually fully pad the text
+                [self._get_width(col_width - (0 if idx == last_idx else 1))
+                    for idx, col_width in enumerate(col_sizes)],
+            )
+        return paddings
+
+    def _print_cells(self, cells):
+        """ prints the text of adjacent cells sharing the same style at once """
+        self.serializer.pre(''.join(cells))
+        self.serializer.end_entity()
+
     def _print_table_row(self, elem, col_sizes):
         sublines = []
 
@@ -394,63 +618,75 @@ class XmlTableLayout(object):
                 # catch index error as it could happen that XML
                 # specifies an incorrect (too few) amount of columns
                 raise Exception(f'Attribute "col-sizes" only contains {len(col_sizes)} elements but {len(elem)} required')
-            
-            sublines.append(zip(
-                textwrap.wrap(td.text or '', width=self._get_width(col_width - self.col_spacing)),
-                itertools.repeat({
+
+            if td.attrib:
+                # extract the align attribute
+                justify = self._JUSTIFY.get(td.attrib.get('align'), str.ljust)
+                style = {
                     # enable bold mode if tag name is "th"
                     'bold': 'on' if td.tag == 'th' else 'off',
                     # copy rest of attributes
                     **td.attrib,
-                })
-            ))
-
-        # iterate over transposed sublines
-        for line in map(list, itertools.zip_longest(*sublines, fillvalue=(None, None))):
-            for idx, (col, style) in enumerate(line):
-                is_first_index = idx == 0
-                is_last_index = idx == (len(col_sizes) - 1)
-                
-                col_width = col_sizes[idx]
-                self.stylestack.push()
-                align = None
-
-                if (style):
-                    # extract the align attribute
-                    align = style.get('align')
-                    # ... and overwrite it with left
+                    # ... and overwrite align with left
                     # the default ESC command for alignment
                     # does not work in this case, as it only works line-wise
                     # but as we are constructing our own table here
                     # all other aligns than 'left' destroy the layout
-                    style['align'] = 'left'
+                    'align': 'left',
+                }
+            else:
+                justify = str.ljust
+                style = self._TH_STYLE if td.tag == 'th' else self._TD_STYLE
+
+            sublines.append(zip(
+                _wrap(td.text or '', self._get_width(col_width - self.col_spacing)),
+                itertools.repeat(style),
+                # only the first line of a wrapped cell is aligned,
+                # continuation lines are left aligned
+                itertools.chain((justify,), itertools.repeat(str.ljust)),
+            ))
+
+        # iterate over transposed sublines
+        for line in map(list, itertools.zip_longest(*sublines, fillvalue=(None, None, str.ljust))):
+            # text of the adjacent cells printed with the style cells_cmd
+            cells = []
+            cells_cmd = None
+            # whether cells holds any text, i.e. any(cells)
+            has_text = False
+
+            for idx, (col, style, justify) in enumerate(line):
+                self.stylestack.push()
+                if style:
                     self.stylestack.set(style)
 
-                self.serializer.start_inline(self.stylestack)
+                cmd = self.stylestack.to_escpos()
+                if cmd != cells_cmd:
+                    # style changes, print what we have so far
+                    if cells_cmd is not None:
+                        self._print_cells(cells)
+                        cells = []
+                        has_text = False
+                    self.serializer.start_inline(self.stylestack)
+                    cells_cmd = cmd
+                elif self.serializer.dirty or has_text:
+                    # same space serializer.start_inline() would add
+                    cells.append(' ')
+                    has_text = True
+
+                spacing, pad_sizes = self._get_paddings(col_sizes)
+                pad_size = pad_sizes[idx]
                 text = (col or '')
                 # makes sure spacing is not added before first col
-                if not is_first_index:
-                    # -1 takes care for the additional space character
-                    # that is introduced by serializer.start_inline()
-                    text = ' ' * self._get_width(self.col_spacing - 1) + text
+                if idx:
+                    text = ' ' * spacing + text
 
-                # again, this -1 takes care for the additional space character
-                # that is introduced by serializer.start_inline()
-                # but for the last column, no serializer.start_inline() will follow
-                # that's why in this case we need to actually fully pad the text
-                pad_size = self._get_width(col_width - (0 if is_last_index else 1))
-                
-                if align == 'right':
-                    text = text.rjust(pad_size)
-                elif align == 'center':
-                    text = text.center(pad_size)
-                else:
-                    text = text.ljust(pad_size)
-
-                self.serializer.pre(text)
-                self.serializer.end_entity()
+                text = justify(text, pad_size)
+                if text:
+                    has_text = True
+                cells.append(text)
                 self.stylestack.pop()
 
+            self._print_cells(cells)
             self.serializer.linebreak()
 
     def print_elem(self, elem, col_sizes=None):
@@ -520,23 +756,43 @@ class Layout(object):
 
     img_cache = {}
 
+    # default styles of elements, applied before the element's attributes
+    _ELEM_STYLES = {
+        'h1': {'bold': 'on', 'size': 'double'},
+        'h2': {'size': 'double'},
+        'h3': {'bold': 'on', 'size': 'double-height'},
+        'h4': {'size': 'double-height'},
+        'h5': {'bold': 'on'},
+        'em': {'font': 'b'},
+        'b': {'bold': 'on'},
+    }
+
     def __init__(self, xml):
-        self._root = root = ET.fromstring(xml.encode('utf-8'))
+        # The document is streamed while printing, see _print_document().
+        # Check that it is well-formed right away with the same parser, so
+        # that a broken document raises here instead of leaving a half printed
+        # receipt. Children of the root element are dropped once parsed.
+        self._xml = xml.encode('utf-8')
+        events = _iterparse(self._xml)
+        event, root = next(events)
+        self._root_attrib = root_attrib = dict(root.attrib)
+        for child in _StreamedRoot(events, root):
+            pass
 
         self.slip_sheet_mode = False
-        if 'sheet' in root.attrib:
-            self.slip_sheet_mode = root.attrib['sheet']
+        if 'sheet' in root_attrib:
+            self.slip_sheet_mode = root_attrib['sheet']
 
-        self.open_crashdrawer = 'open-cashdrawer' in root.attrib and \
-            root.attrib['open-cashdrawer'] == 'true'
+        self.open_crashdrawer = 'open-cashdrawer' in root_attrib and \
+            root_attrib['open-cashdrawer'] == 'true'
 
     def get_base64_image(self, img):
-        id = hashlib.md5(img.encode('utf-8')).hexdigest()
-
-        if id not in self.img_cache:
-            img = img[img.find(',') + 1:]
+        # the data url itself is the cache key: str hashes are cached by
+        # python, so repeated logos don't need to be re-encoded and hashed
+        if img not in self.img_cache:
+            data = img[img.find(',') + 1:]
             f = io.BytesIO()
-            f.write(base64.b64decode(img))
+            f.write(base64.b64decode(data))
             f.seek(0)
             img_rgba = Image.open(f)
             #img = Image.new('RGB', img_rgba.size, (255, 255, 255))
@@ -548,204 +804,289 @@ class Layout(object):
             #else:
                 #img.paste(img_rgba)
 
-            self.img_cache[id] = img_rgba
+            self.img_cache[img] = img_rgba
 
-        return self.img_cache[id]
+        return self.img_cache[img]
 
-    def print_elem(self, stylestack, serializer, elem, printer, indent=0):
-        """Recursively print an element in the document.
-        """
+    def _print_tail(self, stylestack, serializer, elem):
+        serializer.start_inline(stylestack)
+        serializer.text(elem.tail)
+        serializer.end_entity()
 
-        elem_styles = {
-            'h1': {'bold': 'on', 'size': 'double'},
-            'h2': {'size': 'double'},
-            'h3': {'bold': 'on', 'size': 'double-height'},
-            'h4': {'size': 'double-height'},
-            'h5': {'bold': 'on'},
-            'em': {'font': 'b'},
-            'b': {'bold': 'on'},
-        }
+    def _print_bullet(self, stylestack, serializer, bullet):
+        serializer.style(stylestack)
+        serializer.raw(bullet)
 
-        stylestack.push()
-        if elem.tag in elem_styles:
-            stylestack.set(elem_styles[elem.tag])
-        stylestack.set(elem.attrib)
-
-        if elem.tag in (
-            'p',
-            'div',
-            'section',
-            'article',
-            'receipt',
-            'header',
-            'footer',
-            'li',
-            'h1',
-            'h2',
-            'h3',
-            'h4',
-                'h5'):
-            serializer.start_block(stylestack)
-            serializer.text(elem.text)
-            for child in elem:
-                self.print_elem(stylestack, serializer, child, printer)
-                serializer.start_inline(stylestack)
-                serializer.text(child.tail)
-                serializer.end_entity()
-            serializer.end_entity()
-
-        elif elem.tag in ('span', 'em', 'b', 'left', 'right'):
-            serializer.start_inline(stylestack)
-            serializer.text(elem.text)
-            for child in elem:
-                self.print_elem(stylestack, serializer, child, printer)
-                serializer.start_inline(stylestack)
-                serializer.text(child.tail)
-                serializer.end_entity()
-            serializer.end_entity()
+    def _print_line_buffer(self, serializer, lineserializer):
+        serializer.pre(lineserializer.get_line())
 
-        elif elem.tag == 'value':
-            serializer.start_inline(stylestack)
-            serializer.pre(
-                format_value(
-                    elem.text,
-                    decimals=stylestack.get('value-decimals'),
-                    width=stylestack.get('value-width'),
-                    decimals_separator=stylestack.get('value-decimals-separator'),
-                    thousands_separator=stylestack.get('value-thousands-separator'),
-                    autoint=(
-                        stylestack.get('value-autoint') == 'on'),
-                    symbol=stylestack.get('value-symbol'),
-                    position=stylestack.get('value-symbol-position')))
-            serializer.end_entity()
+    # The _print_* methods below print a single element. If there is more
+    # to do for the element (e.g. printing its children), they return a
+    # list of the remaining work, see print_elem().
 
-        elif elem.tag == 'line':
-            width = stylestack.get('width')
-            if stylestack.get('size') in ('double', 'double-width'):
-                width = width / 2
-
-            lineserializer = XmlLineSerializer(
-                stylestack.get('indent') + indent,
-                stylestack.get('tabwidth'),
-                width,
-                stylestack.get('line-ratio'))
-            serializer.start_block(stylestack)
-            for child in elem:
-                if child.tag == 'left':
-                    self.print_elem(
-                        stylestack,
-                        lineserializer,
-                        child,
-                        printer,
-                        indent=indent)
-                elif child.tag == 'right':
-                    lineserializer.start_right()
-                    self.print_elem(
-                        stylestack,
-                        lineserializer,
-                        child,
-                        printer,
-                        indent=indent)
-            serializer.pre(lineserializer.get_line())
-            serializer.end_entity()
-
-        elif elem.tag == 'ul':
+    def _print_container(self, stylestack, serializer, elem, printer, indent):
+        if elem.tag in _BLOCK_TAGS:
             serializer.start_block(stylestack)
-            bullet = stylestack.get('bullet')
+        else:
+            serializer.start_inline(stylestack)
+        if isinstance(elem, _StreamedRoot):
+            # children are still being parsed, queue them as they come
+            todo = [self._iter_container(stylestack, serializer, elem)]
+        else:
+            serializer.text(elem.text)
+            todo = []
             for child in elem:
-                if child.tag == 'li':
-                    serializer.style(stylestack)
-                    serializer.raw(
-                        ' ' * indent * stylestack.get('tabwidth') + bullet)
-                self.print_elem(
+                todo.append((child, serializer, 0))
+                todo.append(functools.partial(self._print_tail, stylestack, serializer, child))
+        todo.append(serializer.end_entity)
+        return todo
+
+    def _iter_container(self, stylestack, serializer, elem):
+        """Yields lists of the work to print the text and children of a
+        _StreamedRoot, in the same order as _print_container() queues it.
+
+        The text before a child and the child's tail are only known once the
+        parser has reached the next child, so each child is fetched before
+        the text that comes before it is printed.
+        """
+        children = iter(elem)
+        child = next(children, None)
+        serializer.text(elem.text)
+        if child is None:
+            return
+        yield [(child, serializer, 0)]
+        for next_child in children:
+            yield [functools.partial(self._print_tail, stylestack, serializer, child),
+                   (next_child, serializer, 0)]
+            child = next_child
+        yield [functools.partial(self._print_tail, stylestack, serializer, child)]
+
+    def _print_value(self, stylestack, serializer, elem, printer, indent):
+        serializer.start_inline(stylestack)
+        serializer.pre(
+            format_value(
+                elem.text,
+                decimals=stylestack.get('value-decimals'),
+                width=stylestack.get('value-width'),
+                decimals_separator=stylestack.get('value-decimals-separator'),
+                thousands_separator=stylestack.get('value-thousands-separator'),
+                autoint=(
+                    stylestack.get('value-autoint') == 'on'),
+                symbol=stylestack.get('value-symbol'),
+                position=stylestack.get('value-symbol-position')))
+        serializer.end_entity()
+
+    def _print_line(self, stylestack, serializer, elem, printer, indent):
+        width = stylestack.get('width')
+        if stylestack.get('size') in ('double', 'double-width'):
+            width = width / 2
+
+        lineserializer = XmlLineSerializer(
+            stylestack.get('indent') + indent,
+            stylestack.get('tabwidth'),
+            width,
+            stylestack.get('line-ratio'))
+        serializer.start_block(stylestack)
+        todo = []
+        for child in elem:
+            if child.tag == 'left':
+                todo.append((child, lineserializer, indent))
+            elif child.tag == 'right':
+                todo.append(lineserializer.start_right)
+                todo.append((child, lineserializer, indent))
+        todo.append(functools.partial(self._print_line_buffer, serializer, lineserializer))
+        todo.append(serializer.end_entity)
+        return todo
+
+    def _print_ul(self, stylestack, serializer, elem, printer, indent):
+        serializer.start_block(stylestack)
+        bullet = stylestack.get('bullet')
+        todo = []
+        for child in elem:
+            if child.tag == 'li':
+                todo.append(functools.partial(
+                    self._print_bullet,
                     stylestack,
                     serializer,
-                    child,
-                    printer,
-                    indent=indent + 1)
-            serializer.end_entity()
-
-        elif elem.tag == 'ol':
-            cwidth = len(str(len(elem))) + 2
-            i = 1
-            serializer.start_block(stylestack)
-            for child in elem:
-                if child.tag == 'li':
-                    serializer.style(stylestack)
-                    serializer.raw(' ' *
-                                   indent *
-                                   stylestack.get('tabwidth') +
-                                   ' ' +
-                                   (str(i) +
-                                    ')').ljust(cwidth))
-                    i = i + 1
-                self.print_elem(
+                    ' ' * indent * stylestack.get('tabwidth') + bullet))
+            todo.append((child, serializer, indent + 1))
+        todo.append(serializer.end_entity)
+        return todo
+
+    def _print_ol(self, stylestack, serializer, elem, printer, indent):
+        cwidth = len(str(len(elem))) + 2
+        i = 1
+        serializer.start_block(stylestack)
+        todo = []
+        for child in elem:
+            if child.tag == 'li':
+                todo.append(functools.partial(
+                    self._print_bullet,
                     stylestack,
                     serializer,
-                    child,
-                    printer,
-                    indent=indent + 1)
-            serializer.end_entity()
-
-        elif elem.tag == 'table':
-            XmlTableLayout(stylestack, serializer).print_elem(elem)
-
-        elif elem.tag == 'pre':
-            serializer.start_block(stylestack)
-            serializer.pre(elem.text)
-            serializer.end_entity()
-
-        elif elem.tag == 'hr':
-            width = stylestack.get('width')
-            if stylestack.get('size') in ('double', 'double-width'):
-                width = width / 2
-            serializer.start_block(stylestack)
-            serializer.text(u'─' * width)
-            serializer.end_entity()
-
-        elif elem.tag == 'br':
-            serializer.linebreak()
-
-        elif elem.tag == 'img':
-            if 'src' in elem.attrib and 'data:' in elem.attrib['src']:
-                printer.image(self.get_base64_image(elem.attrib['src']))
-
-        elif elem.tag == 'barcode' and 'encoding' in elem.attrib:
+                    ' ' *
+                    indent *
+                    stylestack.get('tabwidth') +
+                    ' ' +
+                    (str(i) +
+                     ')').ljust(cwidth)))
+                i = i + 1
+            todo.append((child, serializer, indent + 1))
+        todo.append(serializer.end_entity)
+        return todo
+
+    def _print_table(self, stylestack, serializer, elem, printer, indent):
+        XmlTableLayout(stylestack, serializer).print_elem(elem)
+
+    def _print_pre(self, stylestack, serializer, elem, printer, indent):
+        serializer.start_block(stylestack)
+        serializer.pre(elem.text)
+        serializer.end_entity()
+
+    def _print_hr(self, stylestack, serializer, elem, printer, indent):
+        width = stylestack.get('width')
+        if stylestack.get('size') in ('double', 'double-width'):
+            width = width / 2
+        serializer.start_block(stylestack)
+        serializer.text(u'─' * width)
+        serializer.end_entity()
+
+    def _print_br(self, stylestack, serializer, elem, printer, indent):
+        serializer.linebreak()
+
+    def _print_img(self, stylestack, serializer, elem, printer, indent):
+        if 'src' in elem.attrib and 'data:' in elem.attrib['src']:
+            serializer.flush()
+            printer.image(self.get_base64_image(elem.attrib['src']))
+
+    def _print_barcode(self, stylestack, serializer, elem, printer, indent):
+        if 'encoding' in elem.attrib:
             serializer.start_block(stylestack)
+            serializer.flush()
             printer.barcode(strclean(elem.text), elem.attrib['encoding'])
             serializer.end_entity()
-        
-        elif elem.tag == 'qr':
-            ec = int(elem.attrib.get('ec', stylestack.cmdset.QR_ECLEVEL_L))
-            size = int(elem.attrib.get('size', 3))
-            model = int(elem.attrib.get('model', stylestack.cmdset.QR_MODEL_2))
-            center = bool(elem.attrib.get('center', False))
-            native = bool(elem.attrib.get('native', False))
-            impl = elem.attrib.get('impl', 'bitImageRaster')
-            serializer.start_block(stylestack)
-            printer.qr(elem.text, ec, size, model, native, center, impl)
-            serializer.end_entity()
-        
-        elif elem.tag == 'cut':
-            printer.cut()
 
-        elif elem.tag == 'partialcut':
-            printer.cut(mode='part')
+    def _print_qr(self, stylestack, serializer, elem, printer, indent):
+        ec = int(elem.attrib.get('ec', stylestack.cmdset.QR_ECLEVEL_L))
+        size = int(elem.attrib.get('size', 3))
+        model = int(elem.attrib.get('model', stylestack.cmdset.QR_MODEL_2))
+        center = bool(elem.attrib.get('center', False))
+        native = bool(elem.attrib.get('native', False))
+        impl = elem.attrib.get('impl', 'bitImageRaster')
+        serializer.start_block(stylestack)
+        serializer.flush()
+        printer.qr(elem.text, ec, size, model, native, center, impl)
+        serializer.end_entity()
+
+    def _print_cut(self, stylestack, serializer, elem, printer, indent):
+        serializer.flush()
+        printer.cut()
+
+    def _print_partialcut(self, stylestack, serializer, elem, printer, indent):
+        serializer.flush()
+        printer.cut(mode='part')
+
+    def _print_cashdraw(self, stylestack, serializer, elem, printer, indent):
+        serializer.flush()
+        printer.cashdraw(2)
+        printer.cashdraw(5)
+
+    def _print_codepage(self, stylestack, serializer, elem, printer, indent):
+        number = int(elem.attrib.get('number', 0))
+        serializer.raw(printer.cmd.set_codepage(number))
+        serializer.raw(codepage_test_page())
+
+    def _print_raw(self, stylestack, serializer, elem, printer, indent):
+        # print raw escpos without handling
+        serializer.raw(base64.b64decode(elem.attrib.get('contents', '')))
+
+    # tag -> _print_* method, unknown tags are not printed
+    _HANDLERS = dict.fromkeys(_BLOCK_TAGS | _INLINE_TAGS, _print_container)
+    _HANDLERS.update({
+        'value': _print_value,
+        'line': _print_line,
+        'ul': _print_ul,
+        'ol': _print_ol,
+        'table': _print_table,
+        'pre': _print_pre,
+        'hr': _print_hr,
+        'br': _print_br,
+        'img': _print_img,
+        'barcode': _print_barcode,
+        'qr': _print_qr,
+        'cut': _print_cut,
+        'partialcut': _print_partialcut,
+        'cashdraw': _print_cashdraw,
+        'codepage': _print_codepage,
+        'raw': _print_raw,
+    })
 
-        elif elem.tag == 'cashdraw':
-            printer.cashdraw(2)
-            printer.cashdraw(5)
+    def print_elem(self, stylestack, serializer, elem, printer, indent=0):
+        """Print an element in the document, including all of its children.
+
+        Instead of recursing into child elements, the work that is left to do
+        is kept on an explicit stack. Entries are either ``(elem, serializer,
+        indent)`` tuples for elements that still need to be printed,
+        callables that finish up an element once its children are printed
+        (printing tails, ending entities, popping the element's style), or
+        iterators that produce lists of such entries, one list at a time.
+        """
+
+        # this loop runs for every element and every pending action,
+        # so the lookups it needs are bound to locals
+        work = [(elem, serializer, indent)]
+        pop_work = work.pop
+        elem_styles = self._ELEM_STYLES
+        handlers = self._HANDLERS
+        while work:
+            item = pop_work()
+            if callable(item):
+                item()
+                continue
+            if not isinstance(item, tuple):
+                more = next(item, None)
+                if more is not None:
+                    work.append(item)
+                    work.extend(reversed(more))
+                continue
+            elem, serializer, indent = item
+            # lxml creates a new string on every access to .tag
+            tag = elem.tag
+
+            stylestack.push()
+            if tag in elem_styles:
+                stylestack.set(elem_styles[tag])
+            stylestack.set(elem.attrib)
+
+            handler = handlers.get(tag)
+            todo = handler(self, stylestack, serializer, elem, printer, indent) if handler else None
+
+            # the element's style stays on the stylestack until all
+            # of its remaining work is done
+            if todo:
+                todo.append(stylestack.pop)
+                work.extend(reversed(todo))
+            else:
+                stylestack.pop()
 
-        elif elem.tag == 'codepage':
-            number = int(elem.attrib.get('number', 0))
-            serializer.raw(printer.cmd.set_codepage(number))
-            serializer.raw(codepage_test_page())
+    def _print_document(self, stylestack, serializer, printer):
+        """Parse and print the document.
 
-        elif elem.tag == 'raw':
-            # print raw escpos without handling
-            serializer.raw(base64.b64decode(elem.attrib.get('contents', '')))
+        The children of the root element are printed as soon as they are
+        parsed and are discarded afterwards, see _StreamedRoot. The document
+        has already been parsed the same way in __init__(), so parsing errors
+        are raised there instead.
+        """
+        events = _iterparse(self._xml)
+        event, root = next(events)
 
-        stylestack.pop()
+        if root.tag in _BLOCK_TAGS or root.tag in _INLINE_TAGS:
+            root = _StreamedRoot(events, root)
+        else:
+            # not a container, parse it as a whole
+            for event, elem in events:
+                pass
+        self.print_elem(stylestack, serializer, root, printer)
 
     def format(self, printer):
         """Format the layout to print on the given printer driver.
@@ -753,26 +1094,27 @@ class Layout(object):
 
         stylestack = StyleStack(printer.profile)
         serializer = XmlSerializer(printer)
-        root = self._root
+        root_attrib = self._root_attrib
 
         # Init the mode
         if self.slip_sheet_mode == 'slip':
-            printer._raw(stylestack.cmdset.SHEET_SLIP_MODE)
+            serializer.raw(stylestack.cmdset.SHEET_SLIP_MODE)
         elif self.slip_sheet_mode == 'sheet':
-            printer._raw(stylestack.cmdset.SHEET_ROLL_MODE)
+            serializer.raw(stylestack.cmdset.SHEET_ROLL_MODE)
 
         # init tye styles
-        printer._raw(stylestack.to_escpos())
+        serializer.style(stylestack)
 
         # Print the root element
-        self.print_elem(stylestack, serializer, self._root, printer)
+        self._print_document(stylestack, serializer, printer)
+        serializer.flush()
 
         # Finalize print actions: cut paper, open cashdrawer
         if self.open_crashdrawer:
             printer.cashdraw(2)
             printer.cashdraw(5)
 
-        if 'cut' in root.attrib and root.attrib['cut'] == 'true':
+        if 'cut' in root_attrib and root_attrib['cut'] == 'true':
             if self.slip_sheet_mode == 'slip':
                 printer._raw(stylestack.cmdset.CTL_FF)
             else:
@@ -782,9 +1124,12 @@ class Layout(object):
 def strclean(string):
     if not string:
         string = ''
-    string = string.strip()
-    string = re.sub('\s+', ' ', string)
-    return string
+    return _collapse_whitespace(string)
+
+
+# format strings and separator translation tables used by format_value()
+_FORMAT_CACHE = {}
+_SEPARATORS_CACHE = {}
 
 
 def format_value(
@@ -802,19 +1147,21 @@ def format_value(
 
     if autoint and math.floor(value) == value:
         decimals = 0
-    if width == 0:
-        width = ''
 
-    if thousands_separator:
-        formatstr = "{:" + str(width) + ",." + str(decimals) + "f}"
-    else:
-        formatstr = "{:" + str(width) + "." + str(decimals) + "f}"
+    key = (width, decimals, bool(thousands_separator))
+    formatstr = _FORMAT_CACHE.get(key)
+    if formatstr is None:
+        formatstr = _FORMAT_CACHE[key] = '{:%s%s.%df}' % (
+            width or '', ',' if thousands_separator else '', decimals)
+
+    # swap both separators in a single pass
+    separators = (thousands_separator, decimals_separator)
+    table = _SEPARATORS_CACHE.get(separators)
+    if table is None:
+        table = _SEPARATORS_CACHE[separators] = str.maketrans(
+            {',': thousands_separator, '.': decimals_separator})
 
-    ret = formatstr.format(value)
-    ret = ret.replace(',', 'COMMA')
-    ret = ret.replace('.', 'DOT')
-    ret = ret.replace('COMMA', thousands_separator)
-    ret = ret.replace('DOT', decimals_separator)
+    ret = formatstr.format(value).translate(table)
 
     if symbol:
         if position == 'after':
@@ -824,13 +1171,14 @@ def format_value(
     return ret
 
 
+# the code page dump is constant, so it is only built once
+_CODEPAGE_TEST_PAGE = b'\n'.join(
+    'x{:x} '.format(start).encode('ascii') + b' '.join(
+        bytes((c,)) for c in range(start, start + 16))
+    for start in range(0x20, 0x100, 16))
+
+
 def codepage_test_page():
     """ dumps a code page """
-    out, row = [], []
-    for rowno in range(14):
-        for col in range(16):
-            row.append((0x20+rowno*16+col).to_bytes(1, 'big'))
-        out.append('x{:x} '.format(0x20+rowno*16).encode('ascii') + b' '.join(row))
-        row=[]
-    return b'\n'.join(out)
+    return _CODEPAGE_TEST_PAGE
 